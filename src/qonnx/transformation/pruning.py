@@ -28,8 +28,7 @@
 
 import numpy as np
 import warnings
-from copy import deepcopy
-from functools import reduce
+from collections import deque
 from typing import Dict, Tuple
 
 from qonnx.core.modelwrapper import ModelWrapper
@@ -59,7 +58,7 @@ eltwise_ops_bidirectional = [
 eltwise_ops_bwdonly = ["Add", "Sub", "BatchNormalization"]
 
 # other ops (MatMul, Conv) have more specialized behavior
-# and will be handled by update_node_mask
+# and will be handled by update_dotprod_mask
 
 # mapping of weight tensor axes to input/output channels
 optype_to_w_axis = {
@@ -79,100 +78,229 @@ def ensure_masktype_is_dict(mask):
         raise Exception("Cannot turn %s into dict" % str(mask))
 
 
+def get_cached_mask(model, sparsity, tensor_name):
+    # return the sparsity mask of given tensor from the sparsity dict,
+    # only parsing the annotation from the model on the first access
+    if tensor_name not in sparsity:
+        sparsity[tensor_name] = ensure_masktype_is_dict(model.get_tensor_sparsity(tensor_name))
+    return sparsity[tensor_name]
+
+
+def merge_masks(masks):
+    # take the per-axis union of a list of masks in a single pass,
+    # collecting all sets for each axis before merging them
+    axis_sets = dict()
+    for mask in masks:
+        for key, val in mask.items():
+            axis_sets.setdefault(key, []).append(val)
+    return {key: set().union(*vals) for key, vals in axis_sets.items()}
+
+
 def merge_dicts_of_sets(dict1, dict2):
-    ret = deepcopy(dict1)
-    for key, val in dict2.items():
-        if key in ret.keys():
-            ret[key].update(val)
-        else:
-            ret[key] = val
-    return ret
+    return merge_masks([dict1, dict2])
 
 
-def remove_masked_tensor_channels(tensor_or_shape, mask, axis):
-    shape_only = False
-    if type(mask) is not list:
-        mask_list = list(mask)
+def make_keep_mask(n_chans, mask, keep_buffers=None):
+    # return a boolean mask that is False for the masked channels. if a
+    # dict of keep_buffers is given, the buffer for the same number of
+    # channels is reused instead of allocating a new one. the returned
+    # mask is only valid until the next call with the same keep_buffers.
+    if keep_buffers is None:
+        keep = np.ones(n_chans, dtype=bool)
     else:
-        mask_list = mask
+        if n_chans not in keep_buffers:
+            keep_buffers[n_chans] = np.empty(n_chans, dtype=bool)
+        keep = keep_buffers[n_chans]
+        keep.fill(True)
+    if not isinstance(mask, (list, np.ndarray)):
+        # convert sets of channel indices directly into an index array,
+        # which is faster than indexing with an intermediate list
+        mask = np.fromiter(mask, dtype=np.int64, count=len(mask))
+    keep[mask] = False
+    return keep
+
+
+def remove_masked_tensor_channels(tensor_or_shape, mask, axis, keep_buffers=None):
     if type(tensor_or_shape) in [list, tuple]:
-        shape_only = True
-        tensor_or_shape = np.random.rand(*tensor_or_shape)
+        # compute the new shape arithmetically instead of materializing
+        # a tensor of the given shape
+        new_shape = list(tensor_or_shape)
+        if len(new_shape) == 0 or np.prod(new_shape) == 1:
+            # no pruning for scalar properties
+            return tuple(new_shape)
+        n_chans = new_shape[axis]
+        # same index semantics as the tensor path: negative indices count
+        # from the end, out-of-range indices are an error
+        for x in mask:
+            if not -n_chans <= x < n_chans:
+                raise IndexError("index %d is out of bounds for axis %d with size %d" % (x, axis, n_chans))
+        new_shape[axis] = n_chans - len({x % n_chans for x in mask})
+        return tuple(new_shape)
     assert type(tensor_or_shape) is np.ndarray
     if tensor_or_shape.ndim == 0 or np.prod(tensor_or_shape.shape) == 1:
         # no pruning for scalar properties
         ret = tensor_or_shape
     else:
-        ret = np.delete(tensor_or_shape, mask_list, axis=axis)
-    if shape_only:
-        return ret.shape
+        # single-pass copy of the unmasked channels
+        keep = make_keep_mask(tensor_or_shape.shape[axis], mask, keep_buffers)
+        ret = np.compress(keep, tensor_or_shape, axis=axis)
+    return ret
+
+
+def split_weight_mask(op_type, w_mask):
+    # return the (input, output) channel axes of a MatMul/Conv weight,
+    # followed by the (input, output) channel masks from its weight mask
+    w_axis_in = optype_to_w_axis[op_type]["in"]
+    w_axis_out = optype_to_w_axis[op_type]["out"]
+    return (w_axis_in, w_axis_out, w_mask.get(w_axis_in, set()), w_mask.get(w_axis_out, set()))
+
+
+def remove_masked_weight_channels(w, mask_in, mask_out, axis_in, axis_out, keep_buffers=None):
+    # prune the output channels first so that the input channels are
+    # removed from the already smaller tensor, moving fewer bytes
+    ret = w
+    for axis, mask in [(axis_out, mask_out), (axis_in, mask_in)]:
+        if len(mask) > 0:
+            ret = np.compress(make_keep_mask(ret.shape[axis], mask, keep_buffers), ret, axis=axis)
+    return ret
+
+
+def count_masked_channels(mask):
+    return sum(len(x) for x in mask.values())
+
+
+# the mask update functions below return the updated masks and whether any
+# of them changed. since masks can only grow by taking unions, a mask has
+# changed iff its number of masked channels has changed.
+
+
+def update_bidirectional_mask(node, masks_in, masks_out):
+    # any i/o can mask any/all other i/o
+    # so just take union
+    all_masks = [*masks_in] + [*masks_out]
+    ret = merge_masks(all_masks)
+    ret_size = count_masked_channels(ret)
+    changed = any(count_masked_channels(x) != ret_size for x in all_masks)
+    # duplicate the result for each node input and output
+    masks_in = [ret for x in masks_in]
+    masks_out = [ret for x in masks_out]
+    return (masks_in, masks_out, changed)
+
+
+def update_bwdonly_mask(node, masks_in, masks_out):
+    # output can mask input but not other way around
+    all_masks = [*masks_in] + [*masks_out]
+    ret = merge_masks(all_masks)
+    ret_size = count_masked_channels(ret)
+    changed = any(count_masked_channels(x) != ret_size for x in masks_in)
+    masks_in = [ret for x in masks_in]
+    return (masks_in, masks_out, changed)
+
+
+def update_dotprod_mask(node, masks_in, masks_out):
+    # input and output are essentially decoupled from
+    # each other by means of the weight (except dwise convs)
+    if node.op_type == "Conv":
+        group_attr = get_by_name(node.attribute, "group")
+        groups = group_attr.i if group_attr is not None else 1
+        # TODO smarter check, other kinds of grouped convs out there..
+        is_depthwise = groups > 1
+    else:
+        is_depthwise = False
+
+    # convert back to two distinct int sets to be able to use union etc set ops
+    (w_axis_in, w_axis_out, w_mask_in, w_mask_out) = split_weight_mask(node.op_type, masks_in[1])
+    # take union with i/o masks to update
+    conv_io_chan_axis = 1
+    i_mask = masks_in[0].get(conv_io_chan_axis, set())
+    o_mask = masks_out[0].get(conv_io_chan_axis, set())
+    if is_depthwise:
+        # depthwise convs couple i<->o channels directly,
+        # so merge all four masks with a single union
+        mask_in = w_mask_in.union(i_mask, w_mask_out, o_mask)
+        mask_out = mask_in
+        changed = any(len(x) != len(mask_in) for x in [i_mask, w_mask_out, o_mask])
+    else:
+        mask_in = w_mask_in.union(i_mask)
+        mask_out = w_mask_out.union(o_mask)
+        changed = any(len(x) != len(mask_in) for x in [i_mask, w_mask_in])
+        changed |= any(len(x) != len(mask_out) for x in [o_mask, w_mask_out])
+    if not changed:
+        # nothing to update, keep the existing masks instead of rebuilding them
+        return (masks_in, masks_out, False)
+    # copy the weight mask so that the (possibly cached) input is not modified
+    w_mask = dict(masks_in[1])
+    if is_depthwise:
+        # dw convs to only use output side for weights by convention
+        w_mask[w_axis_out] = mask_out
     else:
-        return ret
+        w_mask[w_axis_out] = mask_out
+        w_mask[w_axis_in] = mask_in
+    masks_in = [{conv_io_chan_axis: mask_in}, w_mask]
+    masks_out = [{conv_io_chan_axis: mask_out}]
+    return (masks_in, masks_out, True)
+
+
+# mapping of op_type to the function that updates the masks around
+# a node of that type, built once instead of checking op_type against
+# each op list for every node
+optype_to_mask_update = {
+    **{x: update_bidirectional_mask for x in eltwise_ops_bidirectional},
+    **{x: update_bwdonly_mask for x in eltwise_ops_bwdonly},
+    "MatMul": update_dotprod_mask,
+    "Conv": update_dotprod_mask,
+}
+
+# when in lossy mode, allow propagation sparsity masks
+# in both directions (e.g. Add nodes will also get pruned)
+optype_to_mask_update_lossy = {
+    **optype_to_mask_update,
+    **{x: update_bidirectional_mask for x in eltwise_ops_bwdonly},
+}
 
 
 def update_node_mask(node, masks_in, masks_out, lossy=True):
     masks_in = [ensure_masktype_is_dict(x) for x in masks_in]
     masks_out = [ensure_masktype_is_dict(x) for x in masks_out]
+    (masks_in, masks_out, _) = dispatch_mask_update(node, masks_in, masks_out, lossy)
+    return (masks_in, masks_out)
+
 
+def dispatch_mask_update(node, masks_in, masks_out, lossy=True):
+    # same as update_node_mask, but all masks must already be dicts
+    # and an additional flag indicates whether any mask has changed
     if lossy:
-        # when in lossy mode, allow propagation sparsity masks
-        # in both directions (e.g. Add nodes will also get pruned)
-        update_bidirectional = eltwise_ops_bidirectional + eltwise_ops_bwdonly
-        update_bwdonly = []
-
-    if node.op_type in update_bidirectional:
-        # any i/o can mask any/all other i/o
-        # so just take union
-        all_masks = [*masks_in] + [*masks_out]
-        ret = reduce(merge_dicts_of_sets, all_masks)
-        # duplicate the result for each node input and output
-        masks_in = [ret for x in masks_in]
-        masks_out = [ret for x in masks_out]
-    elif node.op_type in update_bwdonly:
-        # output can mask input but not other way around
-        all_masks = [*masks_in] + [*masks_out]
-        ret = reduce(merge_dicts_of_sets, all_masks)
-        masks_in = [ret for x in masks_in]
-    elif node.op_type in ["MatMul", "Conv"]:
-        # input and output are essentially decoupled from
-        # each other by means of the weight (except dwise convs)
-        if node.op_type == "Conv":
-            groups = get_by_name(node.attribute, "group")
-            if groups is not None:
-                groups = groups.i
-            else:
-                groups = 1
-            # TODO smarter check, other kinds of grouped convs out there..
-            is_depthwise = groups > 1
-        else:
-            is_depthwise = False
-
-        # convert back to two distinct int sets to be able to use union etc set ops
-        w_mask = masks_in[1]
-        w_axis_in = optype_to_w_axis[node.op_type]["in"]
-        w_axis_out = optype_to_w_axis[node.op_type]["out"]
-        w_mask_in = w_mask.get(w_axis_in, set())
-        w_mask_out = w_mask.get(w_axis_out, set())
-        # take union with i/o masks to update
-        conv_io_chan_axis = 1
-        i_mask = masks_in[0].get(conv_io_chan_axis, set())
-        o_mask = masks_out[0].get(conv_io_chan_axis, set())
-        mask_in = w_mask_in.union(i_mask)
-        mask_out = w_mask_out.union(o_mask)
-        if is_depthwise:
-            # depthwise convs couple i<->o channels directly
-            mask_in = mask_in.union(mask_out)
-            mask_out = mask_in
-            # dw convs to only use output side for weights by convention
-            w_mask[w_axis_out] = mask_out
-        else:
-            w_mask[w_axis_out] = mask_out
-            w_mask[w_axis_in] = mask_in
-        masks_in = [{conv_io_chan_axis: mask_in}, w_mask]
-        masks_out = [{conv_io_chan_axis: mask_out}]
+        mask_update_fxn = optype_to_mask_update_lossy.get(node.op_type)
     else:
+        mask_update_fxn = optype_to_mask_update.get(node.op_type)
+    if mask_update_fxn is None:
         warnings.warn("Can't propagate sparsity mask through op_type %s" % node.op_type)
-    return (masks_in, masks_out)
+        return (masks_in, masks_out, False)
+    return mask_update_fxn(node, masks_in, masks_out)
+
+
+def propagate_node_mask(model, node, sparsity, updated):
+    # update the masks around given node in the sparsity cache (see
+    # get_cached_mask), also recording them in the updated dict to be
+    # written back to the model later. return the names of the tensors
+    # whose masks changed.
+    node_masks_in = [get_cached_mask(model, sparsity, x) for x in node.input]
+    node_masks_out = [get_cached_mask(model, sparsity, x) for x in node.output]
+    if not any(any(x.values()) for x in [*node_masks_in, *node_masks_out]):
+        # no channels masked on any i/o, nothing to propagate
+        return []
+    (new_in, new_out, changed) = dispatch_mask_update(node, node_masks_in, node_masks_out)
+    if not changed:
+        return []
+    changed_tensors = []
+    for tensor_name, old_annot, new_annot in zip(
+        [*node.input, *node.output], [*node_masks_in, *node_masks_out], [*new_in, *new_out]
+    ):
+        sparsity[tensor_name] = new_annot
+        updated[tensor_name] = new_annot
+        if count_masked_channels(new_annot) != count_masked_channels(old_annot):
+            changed_tensors.append(tensor_name)
+    return changed_tensors
 
 
 class ApplyMasks(Transformation):
@@ -194,6 +322,9 @@ class ApplyMasks(Transformation):
             assert isinstance(key, str)
             # - prune spec vals must also be dicts
             assert isinstance(val, dict)
+            # store axes and channels as plain ints (e.g. not np.int64) so the
+            # annotations stay compact and cheap to parse in later passes
+            val = {int(axis): set(map(int, chans)) for axis, chans in val.items()}
             model.set_tensor_sparsity(key, val)
         return (model, False)
 
@@ -210,27 +341,66 @@ class PropagateMasks(Transformation):
 
     def apply(self, model: ModelWrapper) -> Tuple[ModelWrapper, bool]:
         need_rerun = False
+        # cache sparsity masks by tensor name during the traversal, since
+        # each get/set_tensor_sparsity call scans the ONNX annotations.
+        # all mask types are considered as dicts in the cache, otherwise
+        # we end up comparing None and dict()
+        sparsity = {}
+        updated = {}
+
         # traverse graph from inputs to outputs to propagate
         # sparsity masks via per-layer handlers
         for node in model.graph.node:
-            node_masks_in = [model.get_tensor_sparsity(x) for x in node.input]
-            node_masks_out = [model.get_tensor_sparsity(x) for x in node.output]
-            # ensure all mask types are considered as sets
-            # otherwise we end up comparing None and dict()
-            node_masks_in = [ensure_masktype_is_dict(x) for x in node_masks_in]
-            node_masks_out = [ensure_masktype_is_dict(x) for x in node_masks_out]
-            (new_in, new_out) = update_node_mask(node, node_masks_in, node_masks_out)
-            in_changed = new_in != node_masks_in
-            out_changed = new_out != node_masks_out
-            need_rerun |= in_changed
-            need_rerun |= out_changed
-            for inp_name, inp_annot in zip(node.input, new_in):
-                model.set_tensor_sparsity(inp_name, inp_annot)
-            for out_name, out_annot in zip(node.output, new_out):
-                model.set_tensor_sparsity(out_name, out_annot)
+            if len(propagate_node_mask(model, node, sparsity, updated)) > 0:
+                need_rerun = True
+        # write back all updated masks at once
+        for tensor_name, mask in updated.items():
+            model.set_tensor_sparsity(tensor_name, mask)
         return (model, need_rerun)
 
 
+class PropagateMasksOnePass(Transformation):
+    """Propagate the sparsity masks in the network to relevant upstream and
+    downstream layers, like PropagateMasks, but reach the final masks within
+    a single call. Nodes are visited once in forward and once in reverse
+    order, after which only the nodes around tensors whose masks changed in
+    the meantime are visited again."""
+
+    def __init__(self, lossy: bool = True) -> None:
+        super().__init__()
+        self.lossy = lossy
+
+    def apply(self, model: ModelWrapper) -> Tuple[ModelWrapper, bool]:
+        nodes = list(model.graph.node)
+        # map each tensor to the indices of the nodes that produce/consume it
+        tensor_to_nodes = {}
+        for node_ind, node in enumerate(nodes):
+            for tensor_name in [*node.input, *node.output]:
+                tensor_to_nodes.setdefault(tensor_name, []).append(node_ind)
+        sparsity = {}
+        updated = {}
+
+        # forward sweep
+        for node in nodes:
+            propagate_node_mask(model, node, sparsity, updated)
+        # reverse sweep, revisiting nodes around changed tensors until no
+        # masks change anymore
+        worklist = deque(reversed(range(len(nodes))))
+        in_worklist = set(worklist)
+        while len(worklist) > 0:
+            node_ind = worklist.popleft()
+            in_worklist.remove(node_ind)
+            for tensor_name in propagate_node_mask(model, nodes[node_ind], sparsity, updated):
+                for neighbor_ind in tensor_to_nodes[tensor_name]:
+                    if neighbor_ind not in in_worklist:
+                        worklist.append(neighbor_ind)
+                        in_worklist.add(neighbor_ind)
+        # write back all updated masks at once
+        for tensor_name, mask in updated.items():
+            model.set_tensor_sparsity(tensor_name, mask)
+        return (model, False)
+
+
 class RemoveMaskedChannels(Transformation):
     """Remove channels indicated by sparsity masks on the model. The sparsity
     mask annotations will be removed after they have been processed for each
@@ -243,51 +413,54 @@ class RemoveMaskedChannels(Transformation):
 
     def apply(self, model: ModelWrapper) -> Tuple[ModelWrapper, bool]:
         need_rerun = False
+        sparsity = {}
+        # keep mask buffers, reused across tensors with the same number of channels
+        keep_buffers = {}
+        # pending changes to the model, applied after the traversal
+        new_inits = {}
+        new_shapes = {}
+        cleared_sparsity = []
         for node in model.graph.node:
             for ioname in [*node.input, *node.output]:
+                mask = get_cached_mask(model, sparsity, ioname)
+                if mask == {}:
+                    continue
                 io_t = model.get_initializer(ioname)
                 io_shp = model.get_tensor_shape(ioname)
-                mask = model.get_tensor_sparsity(ioname)
-                if mask is None or mask == {}:
-                    continue
                 # print("[RemoveMaskedChannels] tensor %s mask %s: old shape %s" % (ioname, str(mask), str(io_shp)))
                 if io_t is None:
                     # dynamic input/output, no initializer
                     # compute new shape only
                     for target_axis, axis_mask in mask.items():
                         new_shp = remove_masked_tensor_channels(io_shp, axis_mask, axis=target_axis)
-                        model.set_tensor_shape(ioname, new_shp)
+                        new_shapes[ioname] = new_shp
                 else:
                     if node.op_type in ["MatMul"]:
-                        w_axis_in = optype_to_w_axis[node.op_type]["in"]
-                        w_axis_out = optype_to_w_axis[node.op_type]["out"]
-                        w_mask_in = mask.get(w_axis_in, set())
-                        w_mask_out = mask.get(w_axis_out, set())
-                        new_t = remove_masked_tensor_channels(io_t, w_mask_in, axis=w_axis_in)
-                        new_t = remove_masked_tensor_channels(new_t, w_mask_out, axis=w_axis_out)
-                        model.set_initializer(ioname, new_t)
+                        (w_axis_in, w_axis_out, w_mask_in, w_mask_out) = split_weight_mask(node.op_type, mask)
+                        new_t = remove_masked_weight_channels(
+                            io_t, w_mask_in, w_mask_out, w_axis_in, w_axis_out, keep_buffers=keep_buffers
+                        )
+                        new_inits[ioname] = new_t
                     elif node.op_type in ["Conv"]:
-                        w_axis_in = optype_to_w_axis[node.op_type]["in"]
-                        w_axis_out = optype_to_w_axis[node.op_type]["out"]
-                        w_mask_in = mask.get(w_axis_in, set())
-                        w_mask_out = mask.get(w_axis_out, set())
+                        (w_axis_in, w_axis_out, w_mask_in, w_mask_out) = split_weight_mask(node.op_type, mask)
                         ifm_w = io_shp[1]
-                        groups = get_by_name(node.attribute, "group")
-                        if groups is not None:
-                            groups = groups.i
-                        else:
-                            groups = 1
+                        # look up the group attribute once, it's also updated below for dw convs
+                        group_attr = get_by_name(node.attribute, "group")
+                        groups = group_attr.i if group_attr is not None else 1
                         assert groups == 1 or ifm_w == 1, "Unknown grouped conv setting"
                         depthwise = groups > 1
                         if depthwise:
                             # depthwise convs only use the o_mask by convention
-                            new_t = remove_masked_tensor_channels(io_t, w_mask_out, axis=w_axis_out)
+                            new_t = remove_masked_tensor_channels(
+                                io_t, w_mask_out, axis=w_axis_out, keep_buffers=keep_buffers
+                            )
                             # need to update the group attribute to match new n chans
-                            get_by_name(node.attribute, "group").i = new_t.shape[0]
+                            group_attr.i = new_t.shape[0]
                         else:
-                            new_t = remove_masked_tensor_channels(io_t, w_mask_in, axis=w_axis_in)
-                            new_t = remove_masked_tensor_channels(new_t, w_mask_out, axis=w_axis_out)
-                        model.set_initializer(ioname, new_t)
+                            new_t = remove_masked_weight_channels(
+                                io_t, w_mask_in, w_mask_out, w_axis_in, w_axis_out, keep_buffers=keep_buffers
+                            )
+                        new_inits[ioname] = new_t
                     else:
                         new_t = io_t
                         for target_axis, axis_mask in mask.items():
@@ -295,8 +468,10 @@ class RemoveMaskedChannels(Transformation):
                                 # for layers that use broadcasting, param dims have lower dim than input dims
                                 # and the target axis won't exist. try to handle those cases appropriately
                                 if new_t.ndim == 1:
-                                    new_t = remove_masked_tensor_channels(new_t, axis_mask, axis=0)
-                                    model.set_initializer(ioname, new_t)
+                                    new_t = remove_masked_tensor_channels(
+                                        new_t, axis_mask, axis=0, keep_buffers=keep_buffers
+                                    )
+                                    new_inits[ioname] = new_t
                                 elif new_t.ndim == 0:
                                     # don't prune scalar param
                                     continue
@@ -307,14 +482,23 @@ class RemoveMaskedChannels(Transformation):
                                         str(mask),
                                     )
                             else:
-                                new_t = remove_masked_tensor_channels(new_t, axis_mask, axis=target_axis)
-                                model.set_initializer(ioname, new_t)
+                                new_t = remove_masked_tensor_channels(
+                                    new_t, axis_mask, axis=target_axis, keep_buffers=keep_buffers
+                                )
+                                new_inits[ioname] = new_t
                 # clear sparsity annotation since it's already handled
                 # leftover annotations here can lead to erronous removal later
-                model.set_tensor_sparsity(ioname, {})
-                new_shp = model.get_tensor_shape(ioname)
-                # print("[RemoveMaskedChannels] tensor %s : new shape %s" % (ioname, str(new_shp)))
+                sparsity[ioname] = {}
+                cleared_sparsity.append(ioname)
                 need_rerun = True
+        # commit all pending changes to the model at once, so that each
+        # tensor is only looked up in the graph once
+        for ioname, new_t in new_inits.items():
+            model.set_initializer(ioname, new_t)
+        for ioname, new_shp in new_shapes.items():
+            model.set_tensor_shape(ioname, new_shp)
+        for ioname in cleared_sparsity:
+            model.set_tensor_sparsity(ioname, {})
         return (model, need_rerun)
 
 
@@ -357,6 +541,6 @@ class PruneChannels(Transformation):
                 + str([x.name for x in dotprod_nodes_dyn_w])
             )
         model = model.transform(ApplyMasks(self.prune_spec))
-        model = model.transform(PropagateMasks(self.lossy))
+        model = model.transform(PropagateMasksOnePass(self.lossy))
         model = model.transform(RemoveMaskedChannels(self.lossy))
         return (model, False)
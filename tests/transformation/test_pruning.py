@@ -26,19 +26,27 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import pytest
+
 import numpy as np
+from onnx import TensorProto, helper
 
 from qonnx.core.datatype import DataType
+from qonnx.core.modelwrapper import ModelWrapper
 from qonnx.core.onnx_exec import execute_onnx
 from qonnx.transformation.fold_constants import FoldConstants
 from qonnx.transformation.infer_datatypes import InferDataTypes
+from qonnx.transformation.infer_shapes import InferShapes
 from qonnx.transformation.pruning import (
     ApplyMasks,
     PropagateMasks,
+    PropagateMasksOnePass,
     PruneChannels,
     RemoveMaskedChannels,
     remove_masked_tensor_channels,
+    remove_masked_weight_channels,
 )
+from qonnx.util.basic import get_by_name, qonnx_make_model
 from qonnx.util.cleanup import cleanup_model
 from qonnx.util.inference_cost import inference_cost
 from qonnx.util.test import download_model, get_golden_in_and_output
@@ -50,6 +58,105 @@ def test_remove_masked_tensor_channels():
     assert remove_masked_tensor_channels(x, [0, 2], axis=0).shape == (2, 5, 6)
     assert remove_masked_tensor_channels(x, [3], axis=1).shape == (4, 4, 6)
     assert remove_masked_tensor_channels(shp, [3], axis=1) == (4, 4, 6)
+    assert remove_masked_tensor_channels(shp, {0, 2}, axis=0) == (2, 5, 6)
+    # shape-only and tensor paths must agree, including negative indices
+    for mask, axis in [([-1], 1), ([0, -4], 0), ({1, 4, -2}, 2), ([], 1)]:
+        assert remove_masked_tensor_channels(shp, mask, axis=axis) == remove_masked_tensor_channels(x, mask, axis=axis).shape
+    # out-of-range indices are rejected by both
+    with pytest.raises(IndexError):
+        remove_masked_tensor_channels(x, [7], axis=1)
+    with pytest.raises(IndexError):
+        remove_masked_tensor_channels(shp, [7], axis=1)
+
+
+def test_remove_masked_weight_channels():
+    w = np.random.rand(8, 4, 3, 3)
+    golden = np.delete(np.delete(w, [1, 2], axis=1), [0, 5, 7], axis=0)
+    ret = remove_masked_weight_channels(w, {1, 2}, {0, 5, 7}, axis_in=1, axis_out=0)
+    assert (ret == golden).all()
+    # larger Conv weight with both channel axes pruned
+    w = np.random.rand(128, 64, 3, 3)
+    mask_in = set(range(0, 64, 10))
+    mask_out = set(range(3, 128, 10))
+    golden = np.delete(np.delete(w, sorted(mask_in), axis=1), sorted(mask_out), axis=0)
+    ret = remove_masked_weight_channels(w, mask_in, mask_out, axis_in=1, axis_out=0)
+    assert ret.shape == (115, 57, 3, 3)
+    assert (ret == golden).all()
+    # MatMul weight, channel axes swapped
+    w = np.random.rand(16, 12)
+    golden = np.delete(np.delete(w, [4], axis=0), [0, 11], axis=1)
+    ret = remove_masked_weight_channels(w, {4}, {0, 11}, axis_in=0, axis_out=1)
+    assert (ret == golden).all()
+
+
+def make_matmul_chain_model():
+    inp = helper.make_tensor_value_info("inp", TensorProto.FLOAT, [1, 20])
+    outp = helper.make_tensor_value_info("outp", TensorProto.FLOAT, [1, 10])
+    nodes = [
+        helper.make_node("MatMul", ["inp", "W0"], ["mm0_out"]),
+        helper.make_node("Mul", ["mm0_out", "scale0"], ["mul0_out"]),
+        helper.make_node("Relu", ["mul0_out"], ["relu0_out"]),
+        helper.make_node("MatMul", ["relu0_out", "W1"], ["mm1_out"]),
+        helper.make_node("Sub", ["mm1_out", "bias1"], ["outp"]),
+    ]
+    graph = helper.make_graph(nodes, "matmul_chain", [inp], [outp])
+    model = ModelWrapper(qonnx_make_model(graph))
+    model.set_initializer("W0", np.random.rand(20, 30).astype(np.float32))
+    model.set_initializer("scale0", np.random.rand(30).astype(np.float32))
+    model.set_initializer("W1", np.random.rand(30, 10).astype(np.float32))
+    model.set_initializer("bias1", np.random.rand(10).astype(np.float32))
+    return model.transform(InferShapes())
+
+
+def test_apply_masks_numpy_channels():
+    model = make_matmul_chain_model()
+    prune_spec = {"relu0_out": {1: set(np.flatnonzero(np.arange(30) % 10 == 0))}}
+    model = model.transform(ApplyMasks(prune_spec))
+    assert model.get_tensor_sparsity("relu0_out") == {1: {0, 10, 20}}
+
+
+def test_propagate_masks_onepass():
+    model = make_matmul_chain_model()
+    prune_spec = {"relu0_out": {1: {0, 4}}, "W0": {0: {3}, 1: {11}}, "W1": {1: {2}}}
+    model = model.transform(ApplyMasks(prune_spec))
+    model_fixpt = model.transform(PropagateMasks())
+    model_onepass = model.transform(PropagateMasksOnePass())
+    assert model_onepass.get_tensor_sparsity("inp") == {1: {3}}
+    assert model_onepass.get_tensor_sparsity("W0") == {0: {3}, 1: {0, 4, 11}}
+    assert model_onepass.get_tensor_sparsity("W1") == {0: {0, 4, 11}, 1: {2}}
+    assert model_onepass.get_tensor_sparsity("outp") == {1: {2}}
+    for tensor in ["inp", "W0", "mm0_out", "scale0", "mul0_out", "relu0_out", "W1", "mm1_out", "bias1", "outp"]:
+        assert model_onepass.get_tensor_sparsity(tensor) == model_fixpt.get_tensor_sparsity(tensor)
+
+
+def test_pruning_depthwise_conv():
+    inp = helper.make_tensor_value_info("inp", TensorProto.FLOAT, [1, 8, 6, 6])
+    outp = helper.make_tensor_value_info("outp", TensorProto.FLOAT, [1, 4, 6, 6])
+    nodes = [
+        helper.make_node("Conv", ["inp", "W0"], ["conv0_out"], kernel_shape=[3, 3], pads=[1, 1, 1, 1]),
+        helper.make_node("Relu", ["conv0_out"], ["relu0_out"]),
+        helper.make_node("Conv", ["relu0_out", "W1"], ["conv1_out"], kernel_shape=[3, 3], pads=[1, 1, 1, 1], group=16),
+        helper.make_node("Relu", ["conv1_out"], ["relu1_out"]),
+        helper.make_node("Conv", ["relu1_out", "W2"], ["outp"], kernel_shape=[1, 1]),
+    ]
+    graph = helper.make_graph(nodes, "dw_conv_chain", [inp], [outp])
+    model = ModelWrapper(qonnx_make_model(graph))
+    model.set_initializer("W0", np.random.rand(16, 8, 3, 3).astype(np.float32))
+    model.set_initializer("W1", np.random.rand(16, 1, 3, 3).astype(np.float32))
+    model.set_initializer("W2", np.random.rand(4, 16, 1, 1).astype(np.float32))
+    model = model.transform(InferShapes())
+    # masks on both sides of the depthwise conv must be merged
+    prune_spec = {"W0": {0: {1, 3}}, "relu1_out": {1: {9}}}
+    model = model.transform(PruneChannels(prune_spec))
+    assert model.get_initializer("W0").shape == (13, 8, 3, 3)
+    assert model.get_initializer("W1").shape == (13, 1, 3, 3)
+    assert model.get_initializer("W2").shape == (4, 13, 1, 1)
+    dw_node = model.get_nodes_by_op_type("Conv")[1]
+    assert get_by_name(dw_node.attribute, "group").i == 13
+    assert tuple(model.get_tensor_shape("relu1_out")) == (1, 13, 6, 6)
+    inp_t = np.random.rand(1, 8, 6, 6).astype(np.float32)
+    ret = execute_onnx(model, {"inp": inp_t})["outp"]
+    assert ret.shape == (1, 4, 6, 6)
 
 
 def test_apply_and_propagate_masks():